@@ -1,69 +1,170 @@
 import streamlit as st
 import base64
+import hashlib
+import io
 import requests
-import json
+import orjson
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from PIL import Image, ImageOps
+from requests.adapters import HTTPAdapter, Retry
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+# Gemini calls are network-bound, so several can be in flight at once.
+MAX_WORKERS = 8
+# Images sent together in one generateContent request, saving a round-trip and prompt per image.
+IMAGES_PER_REQUEST = 4
+# Larger images are downscaled before upload; OCR quality plateaus well below phone-camera resolutions.
+MAX_IMAGE_SIDE = 1600
+
+@st.cache_resource
+def get_session():
+    """
+    Returns a requests session shared across reruns so keep-alive connections
+    to the Gemini endpoint are reused instead of re-handshaking per image.
+    """
+    session = requests.Session()
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["POST"],
+    )
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=retry)
+    session.mount("https://", adapter)
+    return session
 
 def image_to_base64(uploaded_file):
     """
-    Converts an uploaded file object (from Streamlit) to a base64 encoded string.
+    Converts an uploaded file object (from Streamlit) to base64 encoded bytes.
+    Images larger than MAX_IMAGE_SIDE are downscaled and re-encoded as JPEG first.
     """
     img_bytes = uploaded_file.getvalue()
-    base64_string = base64.b64encode(img_bytes).decode('utf-8')
     mime_type = uploaded_file.type
-    return base64_string, mime_type
 
-def process_image_with_ai(base64_image, mime_type, api_key):
+    # Image.open only reads the header, so small images are sent untouched.
+    # Files PIL can't read are sent as-is too, leaving Gemini to report on them.
+    try:
+        with Image.open(io.BytesIO(img_bytes)) as img:
+            if max(img.size) > MAX_IMAGE_SIDE:
+                img = ImageOps.exif_transpose(img)
+                if img.mode in ("RGBA", "LA", "P"):
+                    # Flatten onto white so transparent areas don't turn black and hide text
+                    img = img.convert("RGBA")
+                    background = Image.new("RGB", img.size, "white")
+                    background.paste(img, mask=img.getchannel("A"))
+                    img = background
+                else:
+                    img = img.convert("RGB")
+                img.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.LANCZOS)
+                buffer = io.BytesIO()
+                img.save(buffer, format="JPEG", quality=85)
+                img_bytes = buffer.getvalue()
+                mime_type = "image/jpeg"
+    except (OSError, Image.DecompressionBombError):
+        pass
+
+    return base64.b64encode(img_bytes), mime_type
+
+class NoTextResponseError(Exception):
     """
-    Sends the image data to the Google Gemini AI for processing.
-    Returns the extracted data as a list of dictionaries.
+    Raised when a Gemini response carries no text part (e.g. a safety block).
+    """
+
+@st.cache_data(show_spinner=False)
+def call_gemini_api(images, api_key):
+    """
+    Sends a batch of (base64_image, mime_type) pairs to the Google Gemini AI in a
+    single request and returns the parsed JSON. Failures, including a response with
+    no text, raise rather than return, so st.cache_data only memoizes successful
+    calls and reruns skip the round-trip.
     """
     api_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-05-20:generateContent?key={api_key}"
     
     prompt = """
-    From the provided image of a leaderboard, extract the names and their corresponding scores. 
-    Return the result as a JSON array of objects, where each object has a 'name' and a 'number' key. 
-    For example: [{ "name": "Player1", "number": 123 }]. 
-    Do not include any other text, explanations, or markdown formatting in your response. Just the raw JSON array.
+    From each of the provided images of a leaderboard, extract the names and their corresponding scores. 
+    Each image is preceded by its label, e.g. "Image 0". 
+    Return the result as a single JSON array of objects, where each object has an 'image_index', a 'name' and a 'number' key. 
+    For example: [{ "image_index": 0, "name": "Player1", "number": 123 }]. 
     """
 
+    parts = [{"text": prompt}]
+    for index, (base64_image, mime_type) in enumerate(images):
+        parts.append({"text": f"Image {index}"})
+        # orjson has no bytes type, so decode at the JSON boundary (ASCII fast path)
+        parts.append({"inlineData": {"mimeType": mime_type, "data": base64_image.decode('ascii')}})
+
     payload = {
         "contents": [{
             "role": "user",
-            "parts": [
-                {"text": prompt},
-                {"inlineData": {"mimeType": mime_type, "data": base64_image}}
-            ]
+            "parts": parts
         }],
+        # Ask for bare JSON matching this schema instead of markdown-wrapped text
+        "generationConfig": {
+            "responseMimeType": "application/json",
+            "responseSchema": {
+                "type": "ARRAY",
+                "items": {
+                    "type": "OBJECT",
+                    "properties": {
+                        "image_index": {"type": "INTEGER"},
+                        "name": {"type": "STRING"},
+                        "number": {"type": "NUMBER"}
+                    },
+                    "required": ["image_index", "name", "number"]
+                }
+            }
+        },
     }
 
     headers = {'Content-Type': 'application/json'}
 
+    response = get_session().post(api_url, headers=headers, data=orjson.dumps(payload))
+    response.raise_for_status()
+    
+    result = orjson.loads(response.content)
+    candidate = result.get('candidates', [{}])[0]
+    content_part = candidate.get('content', {}).get('parts', [{}])[0]
+    
+    if 'text' not in content_part:
+        raise NoTextResponseError()
+
+    return orjson.loads(content_part['text'])
+
+def process_images_with_ai(uploaded_files, api_key):
+    """
+    Encodes a batch of uploaded files and sends them to the Google Gemini AI for processing.
+    Returns the extracted data as a list of dictionaries, in image order.
+    """
     try:
-        response = requests.post(api_url, headers=headers, json=payload)
-        response.raise_for_status()
-        
-        result = response.json()
-        candidate = result.get('candidates', [{}])[0]
-        content_part = candidate.get('content', {}).get('parts', [{}])[0]
-        
-        if 'text' in content_part:
-            response_text = content_part['text']
-            cleaned_json_string = response_text.replace("```json", "").replace("```", "").strip()
-            return json.loads(cleaned_json_string)
-        else:
-            st.warning("AI response did not contain text data for one of the images.")
-            return []
+        images = tuple(image_to_base64(f) for f in uploaded_files)
+        extracted_data = call_gemini_api(images, api_key)
+        extracted_data.sort(key=lambda item: item.get('image_index', 0))
+        return [{k: v for k, v in item.items() if k != 'image_index'} for item in extracted_data]
 
+    except NoTextResponseError:
+        st.warning("AI response did not contain text data for one batch of images.")
     except requests.exceptions.RequestException as e:
         st.error(f"API request failed: {e}")
-    except json.JSONDecodeError:
-        st.error(f"Failed to decode JSON from AI response: {response.text}")
+    except orjson.JSONDecodeError as e:
+        st.error(f"Failed to decode JSON from AI response: {e.doc}")
     except Exception as e:
         st.error(f"An unexpected error occurred: {e}")
     
     return []
 
+def dataframe_to_csv(df):
+    """
+    Converts a DataFrame to CSV bytes with pyarrow's native writer,
+    prefixed with a UTF-8 BOM for Excel compatibility.
+    """
+    buffer = io.BytesIO()
+    buffer.write(b'\xef\xbb\xbf')
+    pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), buffer)
+    return buffer.getvalue()
+
 def main():
     """
     Main function to define the Streamlit application UI and logic.
@@ -83,48 +184,78 @@ def main():
         accept_multiple_files=True
     )
     
+    uploads_key = None
     if uploaded_files:
         st.image(uploaded_files, width=150, caption=[f.name for f in uploaded_files])
 
+        hasher = hashlib.blake2b(digest_size=8)
+        for f in uploaded_files:
+            hasher.update(f.getvalue())
+        uploads_key = hasher.hexdigest()
+
     if st.button("🚀 Process Images"):
         if not api_key:
             st.warning("Please enter your Google AI API key in the sidebar.")
         elif not uploaded_files:
             st.warning("Please upload one or more images.")
         else:
-            all_extracted_data = []
+            names, numbers = [], []
             my_bar = st.progress(0, text="Starting processing...")
 
-            for i, uploaded_file in enumerate(uploaded_files):
-                my_bar.progress((i + 1) / len(uploaded_files), text=f"Processing: {uploaded_file.name}")
-                
-                base64_image, mime_type = image_to_base64(uploaded_file)
-                extracted_data = process_image_with_ai(base64_image, mime_type, api_key)
-                if extracted_data:
-                    all_extracted_data.extend(extracted_data)
+            # Worker threads need the script context so st.warning/st.error still render
+            ctx = get_script_run_ctx()
+            batches = [
+                uploaded_files[i:i + IMAGES_PER_REQUEST]
+                for i in range(0, len(uploaded_files), IMAGES_PER_REQUEST)
+            ]
+            results = [None] * len(batches)
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS, initializer=add_script_run_ctx, initargs=(None, ctx)) as executor:
+                futures = {
+                    executor.submit(process_images_with_ai, batch, api_key): i
+                    for i, batch in enumerate(batches)
+                }
+                for done, future in enumerate(as_completed(futures), start=1):
+                    i = futures[future]
+                    results[i] = future.result()
+                    batch_names = ", ".join(f.name for f in batches[i])
+                    my_bar.progress(done / len(batches), text=f"Processed: {batch_names}")
+
+            # Keep records in upload order regardless of which request finished first
+            for extracted_data in results:
+                for item in extracted_data or []:
+                    names.append(item.get('name'))
+                    numbers.append(item.get('number'))
 
             my_bar.empty()
 
-            if all_extracted_data:
-                st.success(f"Successfully extracted {len(all_extracted_data)} records from {len(uploaded_files)} images!")
+            if names:
+                st.success(f"Successfully extracted {len(names)} records from {len(uploaded_files)} images!")
                 
-                # Use pandas for robust data handling and CSV conversion
-                df = pd.DataFrame(all_extracted_data)
-                df.rename(columns={'name': 'Name', 'number': 'Number'}, inplace=True)
-                st.dataframe(df)
-
-                # Convert dataframe to CSV string, using utf-8-sig for Excel compatibility
-                csv = df.to_csv(index=False).encode('utf-8-sig')
-
-                st.download_button(
-                    label="⬇️ Download Results as CSV",
-                    data=csv,
-                    file_name="leaderboard_data_combined.csv",
-                    mime="text/csv",
-                )
+                # Use pandas for robust data handling
+                df = pd.DataFrame({
+                    'Name': names,
+                    'Number': pd.to_numeric(numbers, errors='coerce', downcast='integer'),
+                })
+                st.session_state['last_key'] = uploads_key
+                st.session_state['df'] = df
+                st.session_state['csv'] = dataframe_to_csv(df)
             else:
+                # Drop any earlier results for these uploads so they aren't shown under the error
+                st.session_state.pop('last_key', None)
                 st.error("Could not extract any data from the uploaded images. Please try with clearer images.")
 
+    # Results live in session_state so the rerun triggered by the download button
+    # (or any other widget) re-renders them without reprocessing the uploads
+    if uploaded_files and st.session_state.get('last_key') == uploads_key:
+        st.dataframe(st.session_state['df'])
+
+        st.download_button(
+            label="⬇️ Download Results as CSV",
+            data=st.session_state['csv'],
+            file_name="leaderboard_data_combined.csv",
+            mime="text/csv",
+        )
+
 if __name__ == "__main__":
     main()
 